@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+'''
+Series string of cells cooled by one coolant chain
+
+All cells of a series string carry the same current. seriesPack steps the cells together with
+the vectorized engine of population.py: the shared current is applied to every cell in one
+step, every cell takes the smallest time step any cell asks for, and the whole string moves to
+the next step of the cycle as soon as one cell meets its stop condition (eg. the weakest cell
+reaching the cutoff voltage). Constant voltage steps hold the string voltage at (number of
+cells) x the voltage of the schedule.
+
+The coolant flows past the cells in the order of the list. Every cell heats the coolant (a
+simple Q=mCpdT, see coolantOutlet and singleCell.calcTambient) and the average of its inlet and
+outlet temperature is the ambient temperature of the cell.
+
+Usage:
+cells = packCells(["supporting_files/parameters.xlsx"], 200, {"positive.Rp": 0.02, "negative.kct": 0.05},
+                  seed=1, maxCycles=2)
+pack = seriesPack(cells, flowRate=2.0, TcoolantIn=298.15)
+pack.run()
+'''
+
+import sys
+import numpy
+from SPM import singleCell, getInputs, coolantOutlet, saveData
+from population import cellPopulation, restoreState
+
+packNames = "cycle,step,totTime_s,stepTime_s,current_A,packVoltage_V,minCellVoltage_V,maxCellVoltage_V," \
+            "maxTemp_K,coolantOut_K,dCap_As,cCap_As"
+
+
+def packCells(parameters_list, count, variation=None, seed=None, maxCycles=1, **cellOptions):
+    '''
+	Returns count singleCell objects for a pack. Every parameter in variation, a dict of
+	"section.parameter": relative standard deviation (eg. {"positive.Rp": 0.02}), is drawn for
+	every cell from a normal distribution around its value in the parameters.
+	For [A, Ea] parameters (kct, Ds) only the pre-exponential A varies.
+	cellOptions are passed on to singleCell (controller, rtol, ...)
+	'''
+    inputs = getInputs(len(parameters_list) == 1, parameters_list[0])
+    random = numpy.random.RandomState(seed)
+
+    cells = []
+    for i in range(count):
+        overrides = {}
+        for key, sigma in sorted((variation or {}).items()):
+            section, name = (key.split('.', 1) + [None])[:2]
+            value = getattr(inputs, section, {}).get(name)
+            if (value is None): raise KeyError("unknown parameter: {0}".format(key))
+            if (isinstance(value, (list, tuple))): value = value[0]
+            overrides[key] = value * (1.0 + sigma * random.standard_normal())
+        cells.append(singleCell(parameters_list, maxCycles, cellNumber=i + 1, writeData=0,
+                                inputs=inputs.override(overrides), **cellOptions))
+    return cells
+
+
+class seriesPack(cellPopulation):
+    """
+    Steps a series string of singleCell objects with a shared current
+
+    Keyword arguments:
+    cells -- list of singleCell objects in the order of the coolant flow. Same requirements as
+             cellPopulation, and all cells need to be at the same point of the schedule, without events
+    flowRate -- coolant flow in LPM, None leaves the ambient temperature of every cell as it is
+    TcoolantIn -- coolant inlet temperature in K, default is the ambient temperature of the first cell
+    verbose -- integer, print every step change of the string
+    """
+
+    def __init__(self, cells, flowRate=None, TcoolantIn=None, verbose=0):
+        cellPopulation.__init__(self, cells, 0)
+        schedule = self.schedule
+        if (schedule.events):
+            raise ValueError("A series pack can't locate events, every cell needs the same time step")
+        for x in [schedule.step, schedule.cycle, schedule.stepIterations, schedule.stepTime, schedule.Iapp['present']]:
+            if (numpy.any(x != x[0])):
+                raise ValueError("All cells of a series pack need to be at the same point of the cycle schedule")
+
+        schedule.lockstep = True
+        schedule.dt = numpy.full(len(cells), numpy.min(schedule.dt))
+        self.verbose = verbose
+        self.flowRate = flowRate
+        self.TcoolantIn = {True: lambda: self.Tamb[0], False: lambda: TcoolantIn}[TcoolantIn is None]()
+        self.TcoolantOut = numpy.array([c.TcoolantOut for c in cells], dtype=float)
+
+    def scatter(self):
+        cellPopulation.scatter(self)
+        for i, c in enumerate(self.cells):
+            c.Tamb = self.Tamb[i]
+            c.TcoolantOut = self.TcoolantOut[i]
+
+    def calcTambient(self):
+        '''
+		Coolant temperatures along the flow path, the vectorized chain of singleCell.calcTambient
+		where the outlet of every cell is the inlet of the next one. The temperature rise over every
+		cell is evaluated at its inlet temperature of the previous sweep. The coolant properties
+		change slowly with T, after three sweeps the error is ~1e-8 K for a 10 K rise along the string
+		'''
+        if (self.flowRate is None): return
+
+        heat = self.Qheat * self.totVolume
+        TcoolantIn = numpy.full(len(heat), self.TcoolantIn, dtype=float)
+        for sweep in range(3):
+            self.TcoolantOut = self.TcoolantIn + numpy.cumsum(coolantOutlet(TcoolantIn, self.flowRate, heat) - TcoolantIn)
+            TcoolantIn = numpy.concatenate([[self.TcoolantIn], self.TcoolantOut[:-1]])
+        self.Tamb = (TcoolantIn + self.TcoolantOut) / 2.0
+
+    def solve(self, mask, start, Tstart):
+        '''
+		Solve the time step of the string. In constant voltage steps the shared current is found
+		by Newton iterations on the string voltage, with the sum of the dV/dI of the cells
+		'''
+        if (not numpy.any(mask & self.schedule.cv)): return cellPopulation.solve(self, mask, start, Tstart)
+
+        dt = self.schedule.dt
+        Vtarget = len(self.cells) * self.schedule.schedule[self.schedule.step[0], 1]
+        self.cvGuess(mask)
+        evaluations = 0
+        while (True):
+            for obj, state in zip([self, self.cathode, self.anode], start):
+                restoreState(obj, state, mask)
+            Iapp = self.schedule.Iapp['present']
+
+            self.calcTemperature(Iapp, dt)
+            self.V['present'] = self.V_cell(Iapp, self.schedule.cycle, self.schedule.totTime, dt, Tstart)
+            evaluations += 1
+
+            if (numpy.any(numpy.isnan(self.V['present']))):
+                print("Error: You're getting NaNs!")
+                sys.exit(0)
+
+            error = numpy.sum(self.V['present']) - Vtarget
+            if (abs(error) < len(self.cells) * self.cvTolerance): break
+            if (evaluations >= 20):
+                print("Warning: constant voltage iterations of the pack are at 20 but moving on")
+                break
+            self.schedule.Iapp['present'] = Iapp - error / numpy.sum(self.dVdI(Iapp, dt, Tstart))
+
+        return numpy.full(len(mask), evaluations, dtype=int)
+
+    def rejectSteps(self, mask, start, Tstart):
+        '''
+		Step rejection of the error controller, see singleCell.rejectSteps. The time step of the
+		string is solved again when any cell is outside the tolerances, with the shortest new dt
+		'''
+        schedule = self.schedule
+        evaluations = numpy.zeros(len(mask), dtype=int)
+        while (True):
+            error = numpy.max(schedule.localError([self.V['present'], self.cathode.soc, self.anode.soc]))
+            if (error <= 1 or schedule.dt[0] <= schedule.dtStart): return evaluations
+
+            dt = max(schedule.dtStart, schedule.dt[0] * max(0.2, 0.9 * numpy.power(error, -0.5)))
+            schedule.resizeTimeStep(numpy.full(len(mask), dt), mask)
+            for obj, state in zip([self, self.cathode, self.anode], start):
+                restoreState(obj, state, mask)
+            evaluations += self.solve(mask, start, Tstart)
+
+    def record(self):
+        ''' Returns the packNames data of the string '''
+        V = self.V['present']
+        return numpy.array([
+            self.schedule.cycle[0],
+            self.schedule.step[0],
+            self.schedule.totTime[0],
+            self.schedule.stepTime[0],
+            self.schedule.Iapp['present'][0],
+            numpy.sum(V),
+            numpy.min(V),
+            numpy.max(V),
+            numpy.max(self.T),
+            self.TcoolantOut[-1],
+            self.capacity["cumulative_discharge"][0],
+            self.capacity["cumulative_charge"][0]])
+
+    def advance(self):
+        '''
+		Advance the string by one time step and return the record() of that step. Every cell
+		continues with the smallest time step any cell asks for
+		'''
+        last_step = self.schedule.step[0]
+        self.calcTambient()
+        data = cellPopulation.advance(self)
+        self.schedule.dt = numpy.full(len(self.cells), numpy.min(self.schedule.dt))
+
+        if (self.verbose and self.schedule.step[0] != last_step):
+            print("pack cycle: {0}\tstep: {1}\tstopped by cells {2}".format(
+                self.schedule.cycle[0], self.schedule.step[0], self.limitingCells(data)))
+        return data
+
+    def limitingCells(self, data):
+        ''' Cells that met the stop condition of the step that ended with the record data '''
+        row = self.schedule.schedule[int(data[1])]
+        V = self.V['present']
+        if (row[2] != 0): return []
+        return numpy.flatnonzero({True: lambda: V <= row[3], False: lambda: V >= row[3]}[data[4] < 0]()).tolist()
+
+    def run(self, writeData=1, fileName="data/pack_{cycle}.csv"):
+        '''
+		Run the string to maxCycles, the packNames data of every time step is written to one
+		file per cycle when writeData is set. The state of every cell is written back at the end
+		'''
+        data = []
+
+        while (numpy.any(self.running())):
+            data.append(self.advance())
+            if (self.schedule.cycle[0] > self.schedule.last_cycle[0]):
+                if (writeData):
+                    saveData(fileName.format(cycle=self.schedule.last_cycle[0]), numpy.array(data), headers=packNames)
+                data = []
+
+        self.scatter()
@@ -0,0 +1,849 @@
+#!/usr/bin/env python
+'''
+Vectorized engine that steps many singleCell instances in lockstep
+
+The state of all cells is stored as structure-of-arrays numpy buffers: the soc profiles
+are (cells x grid) arrays and T, Lsei, Iapp, V, ... are arrays over cells. Every step
+advances all cells together, and cells that hit their own stop conditions (or finish
+their cycles) are handled with per-cell masks.
+
+All cells need the same cycle schedule, active materials and soc solvers, but every
+other parameter (Rp, L, kct, Ds, T, ...) may vary from cell to cell.
+
+Usage:
+cells = [singleCell(parameters_list, maxCycles=4, cellNumber=i, writeData=0) for i in range(100)]
+population = cellPopulation(cells)
+population.run()
+'''
+
+import sys
+import numpy
+from SPM import Eref, dUdT, returnDs, returnMaterial, arrhenius, ionicConductivity, diffusionOperator, saveData, \
+    colNames
+
+
+def copyState(obj, names):
+    ''' Returns copies of the state arrays (or dicts of arrays) listed in names '''
+    saved = {}
+    for name in names:
+        value = getattr(obj, name)
+        if isinstance(value, dict):
+            saved[name] = dict((key, value[key].copy()) for key in value)
+        else:
+            saved[name] = value.copy()
+    return saved
+
+
+def restoreState(obj, saved, mask):
+    ''' Puts the saved state back for the cells where mask is True '''
+
+    def restore(value, old):
+        numpy.copyto(value, old, where=mask.reshape((-1,) + (1,) * (numpy.ndim(value) - 1)))
+
+    for name in saved:
+        value = getattr(obj, name)
+        if isinstance(value, dict):
+            for key in value: restore(value[key], saved[name][key])
+        else:
+            restore(value, saved[name])
+
+
+class electrodePopulation:
+    """ Structure-of-arrays version of the class electrode. Controlled by the class cellPopulation """
+
+    stateNames = ['soc', 'socList', 'socList_lastTimeStep', 'J', 'J_last_timeStep', 'intJ', 'Lsei', 'Rsei',
+                  'phi', 'eta', 'Ds']
+
+    def __init__(self, electrodes):
+
+        def gather(values):
+            return numpy.array([numpy.nan if x is None else x for x in values], dtype=float)
+
+        e0 = electrodes[0]
+        for e in electrodes:
+            if (e.activeMaterialType != e0.activeMaterialType or e.N != e0.N):
+                raise ValueError("All cells in a population need the same active material and grid size")
+
+        self.activeMaterialType = e0.activeMaterialType
+        self.electrodeType = e0.electrodeType
+        self.changeSign = {2: -1.0, 1: 1.0}[self.electrodeType]
+        self.N = e0.N
+        self.diffusion = diffusionOperator(self.N, e0.Rp)
+
+        # parameters
+        for name in ['soc0', 'DsFactor', 'Ms', 'rhos', 'Erefs', 'ks', 'L', 'area', 'Rp', 'cmax', 'surfaceArea',
+                     'porosity', 'Eref_fudge']:
+            setattr(self, name, gather([getattr(e, name) for e in electrodes]))
+        self.kct = {'A': gather([e.kct['A'] for e in electrodes]), 'Ea': gather([e.kct['Ea'] for e in electrodes])}
+        self.i0s = {'A': gather([e.i0s['A'] for e in electrodes]), 'Ea': gather([e.i0s['Ea'] for e in electrodes])}
+
+        # state
+        self.Ds = {'A': gather([e.Ds['A'] for e in electrodes]), 'Ea': gather([e.Ds['Ea'] for e in electrodes])}
+        self.soc = gather([e.soc for e in electrodes])
+        self.socList = numpy.array([e.socList[:, 0] for e in electrodes], dtype=float)
+        self.socList_lastTimeStep = numpy.array([e.socList_lastTimeStep[:, 0] for e in electrodes], dtype=float)
+        self.J = {'J': gather([e.J['J'] for e in electrodes]), 'Js': gather([e.J['Js'] for e in electrodes])}
+        self.J_last_timeStep = {'J': gather([e.J_last_timeStep['J'] for e in electrodes]),
+                                'Js': gather([e.J_last_timeStep['Js'] for e in electrodes])}
+        self.intJ = {'present': gather([e.intJ['present'] for e in electrodes]),
+                     'last_timeStep': gather([e.intJ['last_timeStep'] for e in electrodes])}
+        self.Lsei = {'present': gather([e.Lsei['present'] for e in electrodes]),
+                     'last_timeStep': gather([e.Lsei['last_timeStep'] for e in electrodes])}
+        self.Rsei = gather([e.Rsei for e in electrodes])
+        self.phi = {'present': gather([e.phi['present'] for e in electrodes]),
+                    'last_timeStep': gather([e.phi['last_timeStep'] for e in electrodes])}
+        self.eta = gather([e.eta for e in electrodes])
+
+    def scatter(self, electrodes):
+        ''' Write the state of every cell back into its electrode object '''
+        for i, e in enumerate(electrodes):
+            e.Ds['A'] = self.Ds['A'][i]
+            e.soc = self.soc[i]
+            e.socList[:, 0] = self.socList[i]
+            e.socList_lastTimeStep[:, 0] = self.socList_lastTimeStep[i]
+            e.diffusion.release()
+            for key in self.J: e.J[key] = self.J[key][i]
+            for key in self.J_last_timeStep: e.J_last_timeStep[key] = self.J_last_timeStep[key][i]
+            for key in self.intJ: e.intJ[key] = self.intJ[key][i]
+            for key in self.Lsei: e.Lsei[key] = self.Lsei[key][i]
+            e.Rsei = self.Rsei[i]
+            e.phi['present'] = e.phi['old'] = self.phi['present'][i]
+            e.phi['last_timeStep'] = self.phi['last_timeStep'][i]
+            e.eta = self.eta[i]
+
+    def locCurrent(self, Iapp):
+        self.J['J'] = self.changeSign * Iapp / self.surfaceArea - self.J['Js']
+        return self.J['J']
+
+    def finiteDifference(self, dt, Iapp, totTime, T):
+        ''' Crank Nicholson solution of the spherical diffusion equation for every cell, see electrode.finiteDifference '''
+        J = self.locCurrent(Iapp)
+        Ds = arrhenius(self.Ds['A'], self.Ds['Ea'], T)
+        delta = -J * self.Rp / self.cmax / Ds / 96485.0
+        K = Ds / self.Rp / self.Rp
+
+        socList = self.diffusion.solveBatch(self.socList_lastTimeStep, dt, K, delta,
+                                            numpy.empty_like(self.socList))
+        numpy.copyto(self.socList, socList, where=(totTime > 0)[:, None])
+        return self.socList
+
+    def exponentialIntegrator(self, dt, Iapp, totTime, T):
+        ''' Exponential integrator for every cell, see electrode.exponentialIntegrator '''
+        J = self.locCurrent(Iapp)
+        Ds = arrhenius(self.Ds['A'], self.Ds['Ea'], T)
+        delta = -J * self.Rp / self.cmax / Ds / 96485.0
+        K = Ds / self.Rp / self.Rp
+
+        socList = self.diffusion.solveExponentialBatch(self.socList_lastTimeStep, dt, K, delta,
+                                                       numpy.empty_like(self.socList))
+        numpy.copyto(self.socList, socList, where=(totTime > 0)[:, None])
+        return self.socList
+
+    def calc_intJ(self, dt, Iapp):
+        J = self.locCurrent(Iapp)
+        self.intJ['present'] = self.intJ['last_timeStep'] + ((J / 96485.0 + self.J_last_timeStep[
+            'J'] / 96485.0) / 2.0) * dt
+        return self.intJ['present']
+
+    def polynomialApproximation(self, dt, Iapp, T):
+        ''' Polynomial approximation for every cell, see electrode.polynomialApproximation '''
+        J = self.locCurrent(Iapp)
+        Ds = arrhenius(self.Ds['A'], self.Ds['Ea'], T)
+
+        intJ = self.calc_intJ(dt, Iapp)
+        c_avg = -3.0 / self.Rp * intJ + self.cmax * self.soc0
+        c_surf = (-J / 96485.0 / 5.0 + c_avg * Ds / self.Rp) * self.Rp / Ds
+
+        return c_surf / self.cmax
+
+    def calcSOC(self, dt, Iapp, totTime, T, method="fd"):
+        if (method == "fd"):
+            self.soc = self.finiteDifference(dt, Iapp, totTime, T)[:, -1].copy()
+        elif (method == "exp"):
+            self.soc = self.exponentialIntegrator(dt, Iapp, totTime, T)[:, -1].copy()
+        elif (method == "pa"):
+            self.soc = self.polynomialApproximation(dt, Iapp, T)
+        else:
+            print("Error: Please select either fd, exp or pa for soc solver")
+
+    def butlerVolmer(self, Iapp, ce, alpha, T):
+        ''' Uses BV expression to calc eta '''
+        Rg = 8.3145
+        F = 96485.0
+        J = self.locCurrent(Iapp)
+        soc = numpy.where(self.soc > 1.0, 0.99999, numpy.where(self.soc < 0, 0.00001, self.soc))
+
+        i0 = F * arrhenius(self.kct['A'], self.kct['Ea'], T) * numpy.power(self.cmax - soc * self.cmax,
+                                                                           0.5) * numpy.power(soc * self.cmax,
+                                                                                              0.5) * numpy.power(ce,
+                                                                                                                 0.5)
+        C1 = J / (2.0 * i0)
+        C2 = numpy.sqrt(J * J + 4.0 * i0 * i0) / (2.0 * i0)
+        self.eta = Rg * T / F / alpha * numpy.log(numpy.maximum(C1 - C2, C1 + C2))
+        return self.eta
+
+    def potential(self, Iapp, ce, alpha, T):
+        ''' returns the electrode potential of every cell '''
+        JRfilm = self.locCurrent(Iapp) * self.Rsei
+        self.phi['present'] = self.butlerVolmer(Iapp, ce, alpha, T) + Eref(self.activeMaterialType, self.soc, T,
+                                                                           self.Eref_fudge) + JRfilm
+
+    def dsoc_dJ(self, dt, T, method="fd"):
+        ''' Sensitivity of the surface soc to J of every cell, see electrode.dsoc_dJ '''
+        F = 96485.0
+        Ds = arrhenius(self.Ds['A'], self.Ds['Ea'], T)
+        if (method == "fd"):
+            K = Ds / self.Rp / self.Rp
+            zeros = numpy.zeros_like(self.socList_lastTimeStep)
+            unit = self.diffusion.solveBatch(zeros, dt, K, numpy.ones_like(K), numpy.empty_like(zeros))[:, -1]
+            return -unit * self.Rp / self.cmax / Ds / F
+        elif (method == "exp"):
+            K = Ds / self.Rp / self.Rp
+            zeros = numpy.zeros_like(self.socList_lastTimeStep)
+            unit = self.diffusion.solveExponentialBatch(zeros, dt, K, numpy.ones_like(K),
+                                                        numpy.empty_like(zeros))[:, -1]
+            return -unit * self.Rp / self.cmax / Ds / F
+        return (-self.Rp / Ds / F / 5.0 - 3.0 / self.Rp * dt / F / 2.0) / self.cmax
+
+    def dPotential(self, Iapp, ce, alpha, T, dsocdJ):
+        ''' d(phi)/d(Iapp) of every cell, see electrode.dPotential '''
+        Rg = 8.3145
+        F = 96485.0
+        J = self.J['J']
+        soc = numpy.where(self.soc > 1.0, 0.99999, numpy.where(self.soc < 0, 0.00001, self.soc))
+
+        i0 = F * arrhenius(self.kct['A'], self.kct['Ea'], T) * numpy.power(self.cmax - soc * self.cmax,
+                                                                           0.5) * numpy.power(soc * self.cmax,
+                                                                                              0.5) * numpy.power(ce,
+                                                                                                                 0.5)
+        root = numpy.sqrt(J * J + 4.0 * i0 * i0)
+        detadJ = Rg * T / F / alpha / root
+        detadsoc = -Rg * T / F / alpha * J / root * 0.5 * (1.0 / soc - 1.0 / (1.0 - soc))
+        dErefdsoc = returnMaterial(self.activeMaterialType).dEref(self.soc, T, self.Eref_fudge)
+
+        return self.changeSign / self.surfaceArea * (detadJ + self.Rsei + (detadsoc + dErefdsoc) * dsocdJ)
+
+    def ohmicResistance(self, T, ce, brugg):
+        return self.L / (2.0 * self.area * ionicConductivity(ce, T, brugg, self.porosity))
+
+    def sideReaction(self, Iapp, T, cycle):
+        ''' Side reaction current density for every cell, see electrode.sideReaction '''
+        F = 96485.0
+        Rg = 8.3145
+        alpha = 0.5
+
+        i0 = arrhenius(self.i0s['A'], self.i0s['Ea'], T)
+        JRfilm = self.locCurrent(Iapp) * self.Rsei
+        on = (Iapp > 0) & (cycle > 1)
+
+        Js = numpy.zeros(numpy.shape(self.soc))
+        Js[on] = (-i0 * numpy.exp(-alpha * F / Rg / T * (self.phi['present'] - self.Erefs - JRfilm)))[on]
+        self.J['Js'] = Js
+
+    def Rfilm(self, dt):
+        F = 96485.0
+        self.Lsei['present'] = -self.J['Js'] * self.Ms / self.rhos / F * dt + self.Lsei['last_timeStep']
+        self.Rsei = self.Lsei['present'] / self.ks
+
+    def save_lastTimeStep(self):
+        numpy.copyto(self.socList_lastTimeStep, self.socList)
+        self.J_last_timeStep['J'] = self.J['J'].copy()
+        self.J_last_timeStep['Js'] = self.J['Js'].copy()
+        self.intJ['last_timeStep'] = self.intJ['present'].copy()
+        self.phi['last_timeStep'] = self.phi['present'].copy()
+        self.Lsei['last_timeStep'] = self.Lsei['present'].copy()
+
+
+class schedulePopulation:
+    """ Structure-of-arrays version of the class cycleSchedule. Controlled by the class cellPopulation """
+
+    stateNames = ['step', 'cycle', 'last_cycle', 'stepIterations', 'stepTime', 'totTime', 'dt', 'Iapp', 'cv',
+                  'historyDt', 'historyX', 'historyCount', 'event']
+
+    def __init__(self, schedules, verbose=0):
+        s0 = schedules[0]
+        if (any(row[0] not in (0, 1) for row in s0.schedule)):
+            raise ValueError("A population only runs cc and cv steps")
+        self.schedule = numpy.array(s0.schedule, dtype=float)
+        for s in schedules:
+            if (not numpy.array_equal(numpy.array(s.schedule, dtype=float), self.schedule)
+                    or s.maxCycles != s0.maxCycles):
+                raise ValueError("All cells in a population need the same cycle schedule")
+            if (s.controller != s0.controller or s.events != s0.events):
+                raise ValueError("All cells in a population need the same time step controller and event location")
+
+        self.maxCycles = s0.maxCycles
+        self.verbose = verbose
+        self.step = numpy.array([s.step for s in schedules], dtype=int)
+        self.cycle = numpy.array([s.cycle for s in schedules], dtype=int)
+        self.last_cycle = numpy.array([s.last_cycle for s in schedules], dtype=int)
+        self.stepIterations = numpy.array([s.stepIterations for s in schedules], dtype=int)
+        self.stepTime = numpy.array([s.stepTime for s in schedules], dtype=float)
+        self.totTime = numpy.array([s.totTime for s in schedules], dtype=float)
+        self.dt = numpy.array([s.dt for s in schedules], dtype=float)
+        self.Iapp = {'present': numpy.array([s.Iapp['present'] for s in schedules], dtype=float),
+                     'last_timestep': numpy.array([s.Iapp['last_timestep'] for s in schedules], dtype=float)}
+        self.cv = numpy.array([s.mode == "cv" for s in schedules])
+
+        # error controller, the history holds [V, soc pos, soc neg] of the last three time steps
+        self.controller = s0.controller
+        self.rtol = numpy.array([s.rtol for s in schedules], dtype=float)
+        self.atol = numpy.array([s.atol for s in schedules], dtype=float)
+        self.dtStart = s0.dtStart
+        self.historyDt = numpy.zeros([len(schedules), 3])
+        self.historyX = numpy.zeros([len(schedules), 3, 3])
+        self.historyCount = numpy.array([len(s.history) for s in schedules], dtype=int)
+        for i, s in enumerate(schedules):
+            for k, (dt, x) in enumerate(s.history):
+                self.historyDt[i, 3 - len(s.history) + k] = dt
+                self.historyX[i, 3 - len(s.history) + k] = x
+
+        self.events = s0.events
+        self.event = numpy.array([s.event for s in schedules])
+        self.eventTolerance = s0.eventTolerance
+        self.eventIterations = s0.eventIterations
+
+        # when set, every cell advances its step as soon as one cell meets its stop condition (series strings)
+        self.lockstep = False
+
+    def scatter(self, schedules):
+        for i, s in enumerate(schedules):
+            s.step = int(self.step[i])
+            s.cycle = int(self.cycle[i])
+            s.last_cycle = int(self.last_cycle[i])
+            s.stepIterations = int(self.stepIterations[i])
+            s.stepTime = self.stepTime[i]
+            s.totTime = self.totTime[i]
+            s.dt = self.dt[i]
+            s.Iapp['present'] = self.Iapp['present'][i]
+            s.Iapp['last_timestep'] = self.Iapp['last_timestep'][i]
+            s.mode = {True: "cv", False: "cc"}[bool(self.cv[i])]
+            s.history = [[self.historyDt[i, k], self.historyX[i, k].copy()] for k in
+                         range(3 - self.historyCount[i], 3)]
+            s.event = bool(self.event[i])
+
+    def checkStopCondition(self, voltage):
+        ''' Vectorized cycleSchedule.checkStopCondition '''
+        self.last_cycle = self.cycle.copy()
+        self.stepIterations += 1
+        self.Iapp['last_timestep'] = self.Iapp['present'].copy()
+
+        stopType = self.schedule[self.step, 2]
+        stopCondition = self.schedule[self.step, 3]
+        Iapp = self.Iapp['present']
+
+        met = self.event.copy()
+        met |= (stopType == 0) & (((Iapp < 0) & (voltage <= stopCondition)) | ((Iapp > 0) & (voltage >= stopCondition)))
+        met |= (stopType == 2) & (self.stepTime >= stopCondition)
+        met |= (stopType == 3) & (Iapp <= stopCondition)
+        self.event[:] = False
+        if (self.lockstep and numpy.any(met)): met[:] = True
+
+        if (numpy.any(met)): self.advanceStep(met)
+
+    def stopFunction(self, V, Iapp, stepTime):
+        ''' Vectorized cycleSchedule.stopFunction, nan where there is no stop function '''
+        stopType = self.schedule[self.step, 2]
+        stopCondition = self.schedule[self.step, 3]
+
+        stop = numpy.where((stopType == 0) & (Iapp != 0),
+                           numpy.where(Iapp < 0, stopCondition - V, V - stopCondition), numpy.nan)
+        stop = numpy.where(stopType == 2.0, stepTime - stopCondition, stop)
+        return numpy.where(stopType == 3.0, stopCondition - Iapp, stop)
+
+    def advanceStep(self, mask):
+        ''' Advance the cells in mask to the next step in the cycle '''
+        maxSteps = numpy.shape(self.schedule)[0]
+
+        self.step = numpy.where(mask, numpy.where(self.step == maxSteps - 1, 0, self.step + 1), self.step)
+        self.cycle = self.cycle + (mask & (self.step == 0))
+        self.stepIterations[mask] = 0
+        self.stepTime[mask] = 0
+
+        stepType = self.schedule[self.step, 0]
+        cc = mask & (stepType == 0)
+        self.Iapp['present'] = numpy.where(cc, self.schedule[self.step, 1], self.Iapp['present'])
+        self.cv = numpy.where(cc, False, numpy.where(mask & (stepType == 1), True, self.cv))
+
+        if (self.verbose):
+            for i in numpy.flatnonzero(mask):
+                print("cell: {0}\tcycle: {1}\tstep: {2}".format(i, self.cycle[i], self.step[i]))
+
+    def set_dt(self, V, soc=()):
+        ''' Vectorized cycleSchedule.set_dt '''
+        if (self.controller == "error"):
+            self.errorControl([V] + list(soc))
+            return
+
+        row = self.schedule[self.step]
+        maxdt = row[:, 4]
+        dt_old = self.dt
+        Iapp = self.Iapp['present']
+
+        dt = numpy.where(dt_old >= maxdt, maxdt, dt_old * 1.05)
+
+        discharge = (row[:, 2] == 0) & (Iapp < 0) & (numpy.abs(V - row[:, 3]) < 0.35)
+        charge = (row[:, 2] == 0) & (Iapp > 0) & (numpy.abs(V - row[:, 3]) < 0.25)
+        timed = (row[:, 2] == 2.0) & (self.stepTime + dt > row[:, 3])
+
+        dt = numpy.where(discharge, numpy.where(dt_old / 1.10 < 0.1, 0.1, dt_old / 1.5), dt)
+        dt = numpy.where(charge, numpy.where(dt_old / 1.10 < 0.1, 0.1, dt_old / 1.10), dt)
+        dt = numpy.where(timed, row[:, 3] - self.stepTime, dt)
+
+        self.dt = numpy.where(self.stepIterations < 5, 0.1, dt)
+
+    def errorControl(self, x):
+        ''' Vectorized cycleSchedule.errorControl, x is [V, soc pos, soc neg] '''
+        row = self.schedule[self.step]
+        maxdt = row[:, 4]
+        error = self.localError(x)
+        x = numpy.transpose(numpy.array(x, dtype=float))
+
+        self.historyDt[:, :2] = self.historyDt[:, 1:]
+        self.historyX[:, :2] = self.historyX[:, 1:]
+        self.historyDt[:, 2] = self.dt
+        self.historyX[:, 2] = x
+        self.historyCount = numpy.where(self.stepIterations == 0, 0, numpy.minimum(self.historyCount + 1, 3))
+        count = self.historyCount
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            factor = numpy.where(error > 0, numpy.minimum(2.0, numpy.maximum(0.2, 0.9 * numpy.power(error, -0.5))), 2.0)
+        dt = numpy.minimum(self.dt * factor, maxdt)
+
+        # approach a stop voltage in steps of at most half the remaining distance
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            dVdt = (self.historyX[:, 2, 0] - self.historyX[:, 1, 0]) / self.historyDt[:, 2]
+            distance = row[:, 3] - x[:, 0]
+            approach = (row[:, 2] == 0) & (not self.events) & (count > 1) & (dVdt * distance > 0)
+            dt = numpy.where(approach, numpy.maximum(numpy.minimum(dt, 0.5 * distance / dVdt), self.dtStart), dt)
+        timed = (row[:, 2] == 2.0) & (self.stepTime + dt > row[:, 3])
+        dt = numpy.where(timed, row[:, 3] - self.stepTime, dt)
+
+        self.dt = numpy.where(self.stepIterations == 0, self.dtStart, dt)
+
+    def localError(self, x):
+        ''' Vectorized cycleSchedule.localError, x is [V, soc pos, soc neg] of the present time step '''
+        x = numpy.transpose(numpy.array(x, dtype=float))
+        x0, x1 = self.historyX[:, 1], self.historyX[:, 2]
+        dt1 = self.historyDt[:, 2]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            predicted = x1 + (x1 - x0) * self.dt[:, None] / dt1[:, None]
+            error = numpy.max(numpy.abs(x - predicted) / (self.atol[:, None] + self.rtol[:, None] * numpy.abs(x)),
+                              axis=1)
+        return numpy.where((self.stepIterations > 0) & (self.historyCount >= 2), error, 0.0)
+
+    def advanceTime(self):
+        self.stepTime += self.dt
+        self.totTime += self.dt
+
+    def resizeTimeStep(self, dt, mask):
+        ''' Change the length of the present time step of the cells in mask after advanceTime() '''
+        self.stepTime = numpy.where(mask, self.stepTime + (dt - self.dt), self.stepTime)
+        self.totTime = numpy.where(mask, self.totTime + (dt - self.dt), self.totTime)
+        self.dt = numpy.where(mask, dt, self.dt)
+
+
+class cellPopulation:
+    """
+    Steps a population of singleCell objects in lockstep
+
+    Keyword arguments:
+    cells -- list of singleCell objects with the same schedule, active materials and soc solvers
+    verbose -- integer, print every step change of every cell
+    """
+
+    stateNames = ['T', 'V', 'Qheat', 'capacity', 'energy', 'cvHistory', 'cvCount', 'cvIterations', 'cvStats']
+
+    def __init__(self, cells, verbose=0):
+        c0 = cells[0]
+        for c in cells:
+            if (c.pos_solver != c0.pos_solver or c.neg_solver != c0.neg_solver):
+                raise ValueError("All cells in a population need the same soc solvers")
+
+        def gather(values):
+            return numpy.array(values, dtype=float)
+
+        self.cells = cells
+        self.cellNumber = [c.cellNumber for c in cells]
+        self.pos_solver = c0.pos_solver
+        self.neg_solver = c0.neg_solver
+
+        self.schedule = schedulePopulation([c.schedule for c in cells], verbose)
+        self.cathode = electrodePopulation([c.cathode for c in cells])
+        self.anode = electrodePopulation([c.anode for c in cells])
+        self.sep = {'L': gather([c.sep.L for c in cells]), 'area': gather([c.sep.area for c in cells]),
+                    'porosity': gather([c.sep.porosity for c in cells])}
+
+        # parameters
+        self.isothermal = numpy.array([c.isothermal for c in cells])
+        for name in ['ce', 'Cp', 'h', 'Aexposed', 'alpha', 'totVolume']:
+            setattr(self, name, gather([getattr(c, name) for c in cells]))
+        self.electrolyteFactor = {'A': gather([c.electrolyteFactor['A'] for c in cells]),
+                                  'Ea': gather([c.electrolyteFactor['Ea'] for c in cells])}
+        self.rho = gather([(c.cathode.mass + c.sep.mass + c.anode.mass) / (
+            c.cathode.volume + c.sep.volume + c.anode.volume) for c in cells])
+        self.Tamb = gather([c.Tamb for c in cells])
+        self.RohmCache = None
+
+        # state
+        self.T = gather([c.T for c in cells])
+        self.Qheat = gather([c.Qheat for c in cells])
+        self.V = {'present': gather([c.V['present'] for c in cells]),
+                  'last_timestep': gather([c.V['last_timestep'] for c in cells])}
+        self.capacity = dict((key, gather([c.capacity[key] for c in cells])) for key in c0.capacity)
+        self.energy = dict((key, gather([c.energy[key] for c in cells])) for key in c0.energy)
+
+        # last two [totTime, Iapp] pairs of singleCell.cvHistory for the constant voltage search
+        self.cvTolerance = c0.cvTolerance
+        self.cvHistory = numpy.zeros([len(cells), 2, 2])
+        self.cvCount = numpy.array([len(c.cvHistory) for c in cells], dtype=int)
+        for i, c in enumerate(cells):
+            if (self.cvCount[i] > 0): self.cvHistory[i, 2 - self.cvCount[i]:] = c.cvHistory
+        self.cvIterations = numpy.array([c.cvIterations for c in cells], dtype=int)
+        self.cvStats = dict((key, numpy.array([c.cvStats[key] for c in cells], dtype=int)) for key in c0.cvStats)
+
+    def saveState(self, mask):
+        ''' Snapshot of every state array, only needed when some cells are masked out '''
+        if (numpy.all(mask)): return None
+        return [copyState(self, self.stateNames), copyState(self.schedule, self.schedule.stateNames),
+                copyState(self.cathode, self.cathode.stateNames), copyState(self.anode, self.anode.stateNames)]
+
+    def restoreState(self, saved, mask):
+        if (saved is None): return
+        for obj, state in zip([self, self.schedule, self.cathode, self.anode], saved):
+            restoreState(obj, state, mask)
+
+    def scatter(self):
+        ''' Write the state of every cell back into its singleCell object '''
+        self.schedule.scatter([c.schedule for c in self.cells])
+        self.cathode.scatter([c.cathode for c in self.cells])
+        self.anode.scatter([c.anode for c in self.cells])
+        for i, c in enumerate(self.cells):
+            c.T = self.T[i]
+            c.Qheat = self.Qheat[i]
+            c.V['present'] = self.V['present'][i]
+            for key in c.capacity: c.capacity[key] = self.capacity[key][i]
+            for key in c.energy: c.energy[key] = self.energy[key][i]
+            c.cvHistory = self.cvHistory[i, 2 - self.cvCount[i]:].tolist()
+            c.cvIterations = int(self.cvIterations[i])
+            for key in c.cvStats: c.cvStats[key] = int(self.cvStats[key][i])
+
+    def running(self):
+        ''' True for the cells that have not yet finished maxCycles '''
+        return self.schedule.cycle <= self.schedule.maxCycles
+
+    def Rohm(self, Iapp):
+        ''' Ohmic resistance of every cell, see singleCell.Rohm. Only depends on T, so it is cached '''
+        if (self.RohmCache is not None and numpy.array_equal(self.RohmCache[0], self.T)): return self.RohmCache[1]
+
+        factor = arrhenius(self.electrolyteFactor['A'], self.electrolyteFactor['Ea'], self.T)
+        Rohm = self.cathode.ohmicResistance(self.T, self.ce, 1.5) / factor + self.anode.ohmicResistance(
+            self.T, self.ce, 1.5) / factor + self.sep['L'] / (self.sep['area'] * ionicConductivity(
+            self.ce, self.T, 1.5, self.sep['porosity'])) / factor
+        self.RohmCache = (self.T.copy(), Rohm)
+        return Rohm
+
+    def calcTemperature(self, Iapp, dt):
+        ''' Energy balance of every non-isothermal cell, see singleCell.calcTemperature '''
+        dUdT_pos = dUdT(self.cathode.activeMaterialType, self.cathode.soc)
+        dUdT_neg = dUdT(self.anode.activeMaterialType, self.anode.soc)
+        Rohmic = self.Rohm(Iapp)
+        Cp = self.Cp
+        rho = self.rho
+        V = self.totVolume
+        h = self.h
+        Aexposed = self.Aexposed
+
+        numerator = Cp * rho * self.T * V + dt * Rohmic * Iapp * Iapp + (
+            dt * self.cathode.eta - dt * self.anode.eta) * Iapp + dt * h * self.Tamb * Aexposed
+        denominator = Cp * rho * V + (dt * dUdT_neg - dt * dUdT_pos) * Iapp + dt * h * Aexposed
+        T = numpy.where(self.isothermal, self.T, numerator / denominator)
+
+        if (numpy.any(T > 60 + 273.15)): print("Warning: T=", numpy.max(T), "K")
+        self.T = T
+
+    def calcQheat(self, Iapp):
+        dUdT_pos = dUdT(self.cathode.activeMaterialType, self.cathode.soc)
+        dUdT_neg = dUdT(self.anode.activeMaterialType, self.anode.soc)
+        Rohmic = self.Rohm(Iapp)
+        V = self.totVolume
+
+        self.Qheat = Iapp * self.T / V * (dUdT_pos - dUdT_neg) + Iapp / V * (
+            self.cathode.eta - self.anode.eta + Iapp * Rohmic)
+
+    def calcCapacity(self):
+        ''' calculate the cumulative capacity and energy in As '''
+        Iapp = self.schedule.Iapp['present']
+        Iapp_old = self.schedule.Iapp['last_timestep']
+        V = self.V['present']
+        V_old = self.V['last_timestep']
+        dt = self.schedule.dt
+
+        discharge = Iapp < 0
+        charge = Iapp > 0
+        self.capacity['cumulative_discharge'] += numpy.where(discharge, ((-1.0 * Iapp) + (-1.0 * Iapp_old)) / 2.0 * dt, 0)
+        self.energy['cumulative_discharge'] += numpy.where(discharge, ((-1.0 * Iapp * V) + (
+            -1.0 * Iapp_old * V_old)) / 2.0 * dt, 0)
+        self.capacity['cumulative_charge'] += numpy.where(charge, ((1.0 * Iapp) + (1.0 * Iapp_old)) / 2.0 * dt, 0)
+        self.energy['cumulative_charge'] += numpy.where(charge, ((1.0 * Iapp * V) + (1.0 * Iapp_old * V_old)) / 2.0 * dt, 0)
+
+    def resetCapacities(self, mask):
+        ''' reset capacities of the cells in mask that are at the beginning of a new cycle '''
+        reset = mask & (self.schedule.step == 0) & (self.schedule.stepIterations == 0)
+        nominal = reset & (self.schedule.cycle == 2)
+
+        self.capacity['nominal'] = numpy.where(nominal, self.capacity['cumulative_discharge'], self.capacity['nominal'])
+        self.energy['nominal'] = numpy.where(nominal, self.energy['cumulative_discharge'], self.energy['nominal'])
+        for kind in ['discharge', 'charge']:
+            for quantity in [self.capacity, self.energy]:
+                quantity['lastCycle_' + kind] = numpy.where(reset, quantity['cumulative_' + kind],
+                                                            quantity['lastCycle_' + kind])
+                quantity['cumulative_' + kind] = numpy.where(reset, 0.0, quantity['cumulative_' + kind])
+
+    def cvGuess(self, mask):
+        ''' First guess of the current of the cells in mask, see singleCell.cvGuess '''
+        Iapp = self.schedule.Iapp['present']
+        t1, I1 = self.cvHistory[:, 0, 0], self.cvHistory[:, 0, 1]
+        t2, I2 = self.cvHistory[:, 1, 0], self.cvHistory[:, 1, 1]
+
+        extrapolate = mask & (self.cvCount == 2) & (t2 > t1)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            guess = I2 + (I2 - I1) * (self.schedule.totTime - t2) / (t2 - t1)
+
+        self.schedule.Iapp['present'] = numpy.where(extrapolate, guess, Iapp)
+
+    def dVdI(self, Iapp, dt, Tsolid):
+        ''' Analytic dV/dIapp of every cell at the last V_cell evaluation, see singleCell.dVdI '''
+        dpos = self.cathode.dPotential(Iapp, self.ce, self.alpha, self.T,
+                                       self.cathode.dsoc_dJ(dt, Tsolid, self.pos_solver))
+        dneg = self.anode.dPotential(Iapp, self.ce, self.alpha, self.T,
+                                     self.anode.dsoc_dJ(dt, Tsolid, self.neg_solver))
+        return dpos - dneg + self.Rohm(Iapp)
+
+    def V_cell(self, Iapp, cycle, totTime, dt, Tsolid):
+        ''' Cell voltage of every cell, see V_cell in singleCell.calcCellVoltage '''
+
+        # calc SEI film thickness and resistance
+        self.anode.Rfilm(dt)
+        self.cathode.Rfilm(dt)
+
+        # calc side reaction current density
+        self.anode.sideReaction(Iapp, self.T, cycle)
+        self.cathode.sideReaction(Iapp, self.T, cycle)
+
+        # this is Ds(soc). the factor is a fitting parameter
+        if (self.cathode.activeMaterialType == 'NMC'): self.cathode.Ds['A'] = self.cathode.DsFactor * returnDs(
+            self.cathode.soc, 'NMC')
+
+        self.cathode.calcSOC(dt, Iapp, totTime, Tsolid, method=self.pos_solver)
+        self.anode.calcSOC(dt, Iapp, totTime, Tsolid, method=self.neg_solver)
+
+        # potentials do not depend on the previous internal iteration, one pass is converged
+        self.cathode.potential(Iapp, self.ce, self.alpha, self.T)
+        self.anode.potential(Iapp, self.ce, self.alpha, self.T)
+
+        return self.cathode.phi["present"] - self.anode.phi["present"] + Iapp * self.Rohm(Iapp)
+
+    def solve(self, mask, start, Tstart):
+        '''
+		Solve the time step of the cells in mask, constant voltage cells iterate on the current.
+		Returns the number of V_cell evaluations of every cell
+		'''
+        dt = self.schedule.dt
+        totTime = self.schedule.totTime
+        cycle = self.schedule.cycle
+
+        # constant voltage cells repeat the trial until converged, the other cells are masked out.
+        # As in singleCell, every trial starts from the state at the beginning of the time step
+        # and the current is found by Newton iterations with the analytic dV/dI
+        trial = mask.copy()
+        Vtarget = self.schedule.schedule[self.schedule.step, 1]
+        evaluations = numpy.zeros(len(mask), dtype=int)
+        while (numpy.any(trial)):
+            saved = self.saveState(trial)
+
+            cv = trial & self.schedule.cv
+            if (numpy.any(cv)):
+                self.cvGuess(cv & (evaluations == 0))
+                newton = cv & (evaluations > 0)
+                if (numpy.any(newton)):
+                    with numpy.errstate(divide='ignore', invalid='ignore'):
+                        step = Iapp - (self.V['present'] - Vtarget) / dVdI
+                    self.schedule.Iapp['present'] = numpy.where(newton, step, self.schedule.Iapp['present'])
+                for obj, state in zip([self, self.cathode, self.anode], start):
+                    restoreState(obj, state, cv)
+            Iapp = self.schedule.Iapp['present']
+
+            self.calcTemperature(Iapp, dt)
+            Tsolid = numpy.where(self.schedule.cv, Tstart, self.T)
+            self.V['present'] = self.V_cell(Iapp, cycle, totTime, dt, Tsolid)
+            self.restoreState(saved, ~trial)
+            evaluations[trial] += 1
+
+            if (numpy.any(numpy.isnan(self.V['present'][trial]))):
+                print("Error: You're getting NaNs!")
+                sys.exit(0)
+
+            trial &= self.schedule.cv & (numpy.abs(self.V['present'] - Vtarget) >= self.cvTolerance)
+            if (numpy.any(trial & (evaluations >= 20))):
+                print("Warning: constant voltage iterations are at 20 but moving on for cells {0}".format(
+                    numpy.flatnonzero(trial & (evaluations >= 20))))
+                trial &= (evaluations < 20)
+            if (numpy.any(trial)):
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    dVdI = self.dVdI(Iapp, dt, Tsolid)
+
+        return evaluations
+
+    def rejectSteps(self, mask, start, Tstart):
+        ''' Step rejection of the error controller for the cells in mask, see singleCell.rejectSteps '''
+        schedule = self.schedule
+        evaluations = numpy.zeros(len(mask), dtype=int)
+        while (True):
+            error = schedule.localError([self.V['present'], self.cathode.soc, self.anode.soc])
+            reject = mask & (error > 1) & (schedule.dt > schedule.dtStart)
+            if (not numpy.any(reject)): return evaluations
+
+            with numpy.errstate(divide='ignore'):
+                dt = numpy.maximum(schedule.dtStart, schedule.dt * numpy.maximum(0.2, 0.9 * numpy.power(error, -0.5)))
+            schedule.resizeTimeStep(dt, reject)
+            for obj, state in zip([self, self.cathode, self.anode], start):
+                restoreState(obj, state, reject)
+            evaluations += self.solve(reject, start, Tstart)
+
+    def locateEvent(self, mask, start, Tstart, stopStart):
+        ''' Event location for the cells in mask, see singleCell.locateEvent '''
+        schedule = self.schedule
+        stopType = schedule.schedule[schedule.step, 2]
+        stop = schedule.stopFunction(self.V['present'], schedule.Iapp['present'], schedule.stepTime)
+        with numpy.errstate(invalid='ignore'):
+            locate = mask & (schedule.stepIterations > 0) & (stopStart < 0) & (stop >= 0)
+        schedule.event |= locate
+        stop = numpy.where(locate, stop, 0.0)
+        stopStart = numpy.where(locate, stopStart, -1.0)
+
+        tolerance = numpy.zeros(len(mask))
+        for kind in schedule.eventTolerance: tolerance[stopType == kind] = schedule.eventTolerance[kind]
+        evaluations = numpy.zeros(len(mask), dtype=int)
+        a, stopA = numpy.zeros(len(mask)), stopStart.copy()
+        b, stopB = schedule.dt.copy(), stop.copy()
+        side = numpy.zeros(len(mask), dtype=int)
+        for i in range(schedule.eventIterations):
+            locate &= (numpy.abs(stop) > tolerance)
+            if (not numpy.any(locate)): break
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                dt = numpy.where(locate, (a * stopB - b * stopA) / (stopB - stopA), schedule.dt)
+            schedule.resizeTimeStep(dt, locate)
+            for obj, state in zip([self, self.cathode, self.anode], start):
+                restoreState(obj, state, locate)
+            evaluations += self.solve(locate, start, Tstart)
+            stop = numpy.where(locate, schedule.stopFunction(self.V['present'], schedule.Iapp['present'],
+                                                             schedule.stepTime), stop)
+            below = locate & (stop < 0)
+            above = locate & (stop >= 0)
+            stopB = numpy.where(below & (side == -1), stopB / 2.0, stopB)
+            stopA = numpy.where(above & (side == 1), stopA / 2.0, stopA)
+            a, stopA = numpy.where(below, dt, a), numpy.where(below, stop, stopA)
+            b, stopB = numpy.where(above, dt, b), numpy.where(above, stop, stopB)
+            side = numpy.where(below, -1, numpy.where(above, 1, side))
+
+        # not converged, finish the step at the end of the bracket where the condition is met
+        finish = locate & (numpy.abs(stop) > tolerance) & (stop < 0)
+        if (numpy.any(finish)):
+            schedule.resizeTimeStep(numpy.where(finish, b, schedule.dt), finish)
+            for obj, state in zip([self, self.cathode, self.anode], start):
+                restoreState(obj, state, finish)
+            evaluations += self.solve(finish, start, Tstart)
+
+        return evaluations
+
+    def calcCellVoltage(self, mask):
+        """ The main algorithm for the cells in mask. Calculate the cell voltage for the next time step """
+
+        self.resetCapacities(mask)
+
+        # state at the beginning of the time step for cv trials and event location
+        start = None
+        if (self.schedule.events or self.schedule.controller == "error" or numpy.any(mask & self.schedule.cv)):
+            start = [copyState(self, ['T']), copyState(self.cathode, self.cathode.stateNames),
+                     copyState(self.anode, self.anode.stateNames)]
+        Tstart = self.T.copy()
+        self.cvCount[mask & self.schedule.cv & (self.schedule.stepIterations == 0)] = 0
+        stopStart = self.schedule.stopFunction(self.V['present'], self.schedule.Iapp['present'],
+                                               self.schedule.stepTime - self.schedule.dt)
+
+        evaluations = self.solve(mask, start, Tstart)
+        if (self.schedule.controller == "error"): evaluations += self.rejectSteps(mask, start, Tstart)
+        if (self.schedule.events): evaluations += self.locateEvent(mask, start, Tstart, stopStart)
+
+        self.cvIterations[mask] = evaluations[mask]
+        done = mask & self.schedule.cv
+        self.cvHistory[done, 0] = self.cvHistory[done, 1]
+        self.cvHistory[done, 1, 0] = self.schedule.totTime[done]
+        self.cvHistory[done, 1, 1] = self.schedule.Iapp['present'][done]
+        self.cvCount[done] = numpy.minimum(self.cvCount[done] + 1, 2)
+        self.cvStats['steps'][done] += 1
+        self.cvStats['evaluations'][done] += evaluations[done]
+        self.cvStats['max'][done] = numpy.maximum(self.cvStats['max'][done], evaluations[done])
+
+        # done cv iterations -> move to next time step
+        saved = self.saveState(mask)
+        Iapp = self.schedule.Iapp['present']
+        self.calcQheat(Iapp)
+        self.cathode.save_lastTimeStep()
+        self.anode.save_lastTimeStep()
+        self.calcCapacity()
+        self.restoreState(saved, ~mask)
+
+    def record(self):
+        ''' Returns the colNames data of every cell as a (cells x 12) array '''
+        return numpy.transpose([
+            self.schedule.cycle,
+            self.schedule.step,
+            self.schedule.totTime,
+            self.schedule.stepTime,
+            self.schedule.Iapp['present'],
+            self.V['present'],
+            self.capacity["cumulative_discharge"],
+            self.capacity["cumulative_charge"],
+            self.cathode.soc,
+            self.anode.soc,
+            self.T,
+            self.Qheat])
+
+    def advance(self):
+        '''
+		Advance every running cell by one time step and return the record() of that step,
+		taken before the stop conditions are checked (as in SPM.main)
+		'''
+        run = self.running()
+        saved = self.saveState(run)
+
+        self.schedule.advanceTime()
+        self.calcCellVoltage(run)
+        data = self.record()
+        self.schedule.checkStopCondition(self.V['present'])
+        self.schedule.set_dt(self.V['present'], soc=[self.cathode.soc, self.anode.soc])
+
+        self.restoreState(saved, ~run)
+        return data
+
+    def run(self, writeData=1, fileName="data/cell{cell}_{cycle}.csv"):
+        '''
+		Run every cell to maxCycles. As in SPM.main, the data of each cell is written to
+		one file per cycle when writeData is set
+		'''
+        data = [[] for c in self.cells]
+
+        while (numpy.any(self.running())):
+            run = self.running()
+            add_data = self.advance()
+
+            for i in numpy.flatnonzero(run): data[i].append(add_data[i])
+            for i in numpy.flatnonzero(run & (self.schedule.cycle > self.schedule.last_cycle)):
+                if (writeData):
+                    saveData(fileName.format(cell=self.cellNumber[i], cycle=self.schedule.last_cycle[i]),
+                             numpy.array(data[i]), headers=colNames)
+                data[i] = []
+
+        self.scatter()
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+'''
+Parallel parameter sweeps around a base parameter set
+
+The base parameters are parsed once (getInputs), every run is a copy of them with some
+parameters replaced (getInputs.override) and the runs are spread over a process pool.
+Each run writes its csv files, a log of its console output and the overrides it used to
+its own directory, so runs never share files. At the end a summary of every run is written
+to summary.csv and the aggregate throughput (runs/hour, simulated seconds per wall second)
+is printed.
+
+Usage:
+runs = overrideGrid({"positive.Rp": [4e-6, 6e-6], "others.T": [283.15, 298.15]})
+results = parameterSweep(["supporting_files/parameters.xlsx"], runs, maxCycles=2, workers=4).run()
+
+or from the command line:
+python sweep.py supporting_files/parameters.xlsx --set positive.Rp=4e-6,6e-6 --set others.T=283.15,298.15 \
+    --cycles 2 --workers 4
+
+Branches of one cell state (forkSweep) run the same way, the common prefix is simulated once:
+cell = singleCell(["supporting_files/parameters.xlsx"], maxCycles=2); cell.run()
+results = forkSweep(cell, [{"cycles": 8}, {"cycles": 8, "set": {"Tamb": 318.15}}], workers=2).run()
+or from a checkpoint file: forkSweep("data/cell1.checkpoint", branches)
+'''
+
+import os, sys, time, json, itertools, argparse
+import multiprocessing
+from SPM import singleCell, getInputs, resultsStore, dataRecorder, columnarRecorder, decimatedRecorder, colNames, \
+    loadCheckpoint
+
+
+def overrideGrid(axes):
+    '''
+	Returns the list of override dicts of the full factorial grid of axes,
+	a dict of "section.parameter": list of values. The axes are taken in sorted order, the last varies fastest
+	'''
+    names = sorted(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*[axes[name] for name in names])]
+
+
+def runCell(task):
+    '''
+	Run one cell of a sweep, task is a dict with the keys run, parameters (parameters_list), inputs,
+	maxCycles, directory, cellOptions and optionally database (a resultsStore file, used instead of
+	csv files), metadata (stored with the run in the database), recording (keyword arguments
+	of decimatedRecorder, eg. {'mode': 'deadband'}), format ("csv" or "columnar", see columnarRecorder)
+	and cell (a singleCell to continue, eg. from singleCell.fork, instead of a new one).
+	Returns a dict with the run statistics, failures are returned as well instead of stopping the sweep
+	'''
+    directory = task['directory']
+    result = {'run': task['run'], 'directory': directory, 'simTime': 0.0, 'steps': 0, 'dischargeCapacity': 0.0,
+              'status': 'ok'}
+
+    if (not os.path.isdir(directory)): os.makedirs(directory)
+    stdout = sys.stdout
+    start = time.time()
+    cell, recorder, store = None, None, None
+    with open(os.path.join(directory, 'log.txt'), 'w') as log:
+        sys.stdout = log
+        try:
+            cell = task.get('cell') or singleCell(task['parameters'], maxCycles=task['maxCycles'],
+                                                  cellNumber=task['run'], writeData=1, inputs=task['inputs'],
+                                                  **task['cellOptions'])
+            if (task.get('database')):
+                store = resultsStore(task['database'])
+                recorder = store.recorder(cell, metadata=task.get('metadata'))
+                result['databaseRun'] = recorder.run
+            else:
+                recorder = {'csv': lambda: dataRecorder(headers=colNames),
+                            'columnar': lambda: columnarRecorder(os.path.join(directory, "cell{0}.col".format(
+                                task['run'])))}[task.get('format', 'csv')]()
+            if (task.get('recording')): recorder = decimatedRecorder(recorder, **task['recording'])
+            result['steps'] = cell.run(writeData=1, fileName=os.path.join(directory, "cell{cell}_{cycle}.csv"),
+                                       recorder=recorder, summaryFile=os.path.join(directory, "cell{cell}_summary.csv"))
+            result['simTime'] = float(cell.schedule.totTime) - task.get('startTime', 0.0)
+            result['dischargeCapacity'] = float(cell.capacity['cumulative_discharge'])
+        except (Exception, SystemExit) as e:  # V_cell calls sys.exit on a diverged solution
+            result['status'] = "failed: {0}: {1}".format(type(e).__name__, e)
+            print(result['status'])
+        finally:
+            # a failed run keeps its buffered rows and the summary of the cycle it stopped in
+            if (recorder is not None): recorder.close()
+            if (getattr(cell, 'summary', None) is not None): cell.summary.close()
+            if (store is not None): store.close()
+            sys.stdout = stdout
+    result['wallTime'] = time.time() - start
+    return result
+
+
+class parameterSweep:
+    """
+    Runs a list of parameter overrides of one base parameter set in parallel
+
+    parameters_list -- list, the base parameters as for singleCell (xlsx, or csv and schedule file)
+    overrides -- list of dicts of "section.parameter": value, see getInputs.override and overrideGrid
+    maxCycles -- integer, the number of cycles of every run
+    outputDirectory -- string, every run writes to outputDirectory/run<index>
+    workers -- integer, size of the process pool, None for one per cpu, 1 runs in this process
+    cellOptions -- dict, extra keyword arguments of singleCell (controller, rtol, atol, events, ...)
+    database -- string, a resultsStore file that gets the time steps of every run instead of csv files
+    recording -- dict, keyword arguments of decimatedRecorder to thin out the recorded time steps
+    format -- string, "csv" files per cycle or one "columnar" binary dataset per run (columnarRecorder)
+    """
+
+    def __init__(self, parameters_list, overrides, maxCycles=4, outputDirectory="data/sweep", workers=None,
+                 cellOptions=None, database=None, recording=None, format="csv"):
+        self.parameters_list = parameters_list
+        self.overrides = list(overrides)
+        self.maxCycles = maxCycles
+        self.outputDirectory = outputDirectory
+        self.workers = workers or multiprocessing.cpu_count()
+        self.cellOptions = cellOptions or {}
+        self.database = database
+        self.recording = recording
+        self.format = format
+
+        # parse the base parameters once, the workers only get copies
+        self.inputs = getInputs(len(parameters_list) == 1, parameters_list[0])
+        self.results = []
+
+    def tasks(self):
+        ''' One task per run, the overrides are applied here so bad parameter names fail before any run starts '''
+        tasks = []
+        for index, overrides in enumerate(self.overrides):
+            directory = os.path.join(self.outputDirectory, "run{0:04d}".format(index))
+            if (not os.path.isdir(directory)): os.makedirs(directory)
+            with open(os.path.join(directory, 'overrides.json'), 'w') as f:
+                json.dump(overrides, f, indent=1, sort_keys=True)
+            tasks.append({'run': index, 'parameters': self.parameters_list, 'inputs': self.inputs.override(overrides),
+                          'maxCycles': self.maxCycles, 'directory': directory, 'cellOptions': self.cellOptions,
+                          'database': self.database, 'metadata': {'sweepRun': index, 'overrides': overrides},
+                          'recording': self.recording, 'format': self.format})
+        return tasks
+
+    def run(self):
+        ''' Run every case, write the summary and report the throughput. Returns the results ordered by run '''
+        tasks = self.tasks()
+        start = time.time()
+        results = []
+
+        if (self.workers == 1):
+            for task in tasks:
+                results.append(runCell(task))
+                self.progress(results, len(tasks))
+        else:
+            pool = multiprocessing.Pool(min(self.workers, len(tasks)))
+            try:
+                for result in pool.imap_unordered(runCell, tasks):
+                    results.append(result)
+                    self.progress(results, len(tasks))
+            finally:
+                pool.close()
+                pool.join()
+
+        self.wallTime = time.time() - start
+        self.results = sorted(results, key=lambda result: result['run'])
+        self.writeSummary()
+        self.report()
+        return self.results
+
+    def progress(self, results, total):
+        result = results[-1]
+        print("run {0} ({1}/{2}) {3} in {4:.1f} s, {5:.0f} simulated s".format(
+            result['run'], len(results), total, result['status'], result['wallTime'], result['simTime']))
+
+    def throughput(self):
+        ''' Aggregate throughput of the last run(): runs/hour and simulated seconds per wall second '''
+        wallTime = max(self.wallTime, 1e-9)
+        return {'runs': len(self.results),
+                'failed': len([r for r in self.results if r['status'] != 'ok']),
+                'wallTime': self.wallTime,
+                'runsPerHour': len(self.results) / wallTime * 3600.0,
+                'simSecondsPerWallSecond': sum([r['simTime'] for r in self.results]) / wallTime}
+
+    def report(self):
+        stats = self.throughput()
+        print("{runs} runs ({failed} failed) in {wallTime:.1f} s with {workers} workers: {runsPerHour:.1f} runs/hour, "
+              "{simSecondsPerWallSecond:.0f} simulated s per wall s".format(workers=self.workers, **stats))
+
+    def writeSummary(self):
+        ''' One line per run with its overrides and statistics in outputDirectory/summary.csv '''
+        names = sorted(set(itertools.chain(*[self.overrides[r['run']].keys() for r in self.results])))
+        columns = ['run', 'status', 'wallTime', 'simTime', 'steps', 'dischargeCapacity']
+        with open(os.path.join(self.outputDirectory, 'summary.csv'), 'w') as f:
+            f.write('# ' + ','.join(columns + names) + '\n')
+            for r in self.results:
+                overrides = self.overrides[r['run']]
+                row = [str(r[c]).replace(",", ";") for c in columns] + \
+                      [str(overrides.get(n, "")).replace(",", ";") for n in names]
+                f.write(",".join(row) + "\n")
+
+
+class forkSweep(parameterSweep):
+    """
+    Runs branches of one cell state in parallel, see singleCell.fork
+
+    cell -- singleCell, or the file name of a checkpoint (loadCheckpoint, its run is not touched)
+    branches -- list of dicts, the branches of singleCell.fork (cycles, maxCycles, schedule, set)
+    outputDirectory -- string, every branch writes to outputDirectory/branch<index>
+    workers, database, recording, format -- as for parameterSweep
+    """
+
+    def __init__(self, cell, branches, outputDirectory="data/forks", workers=None, database=None, recording=None,
+                 format="csv"):
+        if (not isinstance(cell, singleCell)): cell = loadCheckpoint(cell, resume=False)
+        self.cell = cell
+        self.overrides = list(branches)
+        self.outputDirectory = outputDirectory
+        self.workers = workers or multiprocessing.cpu_count()
+        self.database = database
+        self.recording = recording
+        self.format = format
+        self.results = []
+
+    def tasks(self):
+        ''' One task per branch, the cell is forked here so bad branches fail before any run starts '''
+        cells = self.cell.fork([dict(branch, cellNumber=index) for index, branch in enumerate(self.overrides)])
+        tasks = []
+        for index, (branch, cell) in enumerate(zip(self.overrides, cells)):
+            directory = os.path.join(self.outputDirectory, "branch{0:04d}".format(index))
+            if (not os.path.isdir(directory)): os.makedirs(directory)
+            with open(os.path.join(directory, 'branch.json'), 'w') as f:
+                json.dump(branch, f, indent=1, sort_keys=True)
+            tasks.append({'run': index, 'cell': cell, 'startTime': float(self.cell.schedule.totTime),
+                          'directory': directory, 'database': self.database,
+                          'metadata': {'forkBranch': index, 'branch': branch, 'forkCycle': self.cell.schedule.cycle},
+                          'recording': self.recording, 'format': self.format})
+        return tasks
+
+
+def parseValue(text):
+    ''' Numbers where possible, otherwise the string (eg. positive.method=Finite difference) '''
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a parallel parameter sweep of the single particle model")
+    parser.add_argument('parameters', nargs='+', help="xlsx parameter file, or csv parameter and schedule files")
+    parser.add_argument('--set', action='append', default=[], metavar='SECTION.PARAMETER=V1,V2,...',
+                        help="grid axis, eg. positive.Rp=4e-6,6e-6 or currentFactor=0.5,1,2 (repeatable)")
+    parser.add_argument('--list', help="json file with a list of override dicts, run instead of the grid")
+    parser.add_argument('--cycles', type=int, default=4, help="number of cycles of every run")
+    parser.add_argument('--workers', type=int, default=None, help="size of the process pool (default: cpu count)")
+    parser.add_argument('--output', default="data/sweep", help="output directory, one subdirectory per run")
+    parser.add_argument('--controller', default="heuristic", choices=["heuristic", "error"])
+    parser.add_argument('--events', action='store_true', help="end steps exactly on their stop conditions")
+    parser.add_argument('--results', help="store the time steps in this SQLite results database, not in csv files")
+    parser.add_argument('--recording', default="every", choices=["every", "interval", "deadband"],
+                        help="which time steps are recorded, see SPM.decimatedRecorder")
+    parser.add_argument('--format', default="csv", choices=["csv", "columnar"], help="output format of every run")
+    parser.add_argument('--interval', type=float, default=60.0, help="s between recorded rows of --recording interval")
+    args = parser.parse_args()
+
+    if (args.list):
+        with open(args.list) as f:
+            overrides = json.load(f)
+    else:
+        axes = {}
+        for axis in args.set:
+            name, values = axis.split('=', 1)
+            axes[name] = [parseValue(value) for value in values.split(',')]
+        overrides = overrideGrid(axes)
+
+    sweep = parameterSweep(args.parameters, overrides, maxCycles=args.cycles, outputDirectory=args.output,
+                           workers=args.workers, cellOptions={'controller': args.controller, 'events': args.events},
+                           database=args.results, recording={'mode': args.recording, 'interval': args.interval},
+                           format=args.format)
+    sweep.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 
+import os
+import re
+import glob
+import json
 import numpy
+import sqlite3
 import pandas
 import matplotlib.pyplot as plt
 pandas.options.mode.chained_assignment = None  # default='warn'
@@ -144,6 +149,254 @@ def plotData(x,y):
 	#plt.savefig("test.png")
 	plt.show()
 	
+class columnarData:
+	'''
+	Read a binary columnar dataset written by SPM.columnarRecorder, every column is a read-only
+	numpy.memmap, so slicing by column and row range does not copy or parse anything
+	
+	Usage:
+	data = columnarData("data/cell1.col")
+	V = data['voltage_V'][1000:2000]
+	arr = data.array(['totTime_s','voltage_V'],start=1000,stop=2000)
+	'''
+	
+	def __init__(self,directory):
+		self.directory = directory
+		with open(os.path.join(directory,'header.json')) as f:
+			header = json.load(f)
+		self.columns = [str(name) for name in header['columns']]
+		self.dtypes = dict(zip(self.columns,[numpy.dtype(str(dtype)) for dtype in header['dtypes']]))
+		self.rows = header['rows']
+		self.maps = {}
+	
+	def __len__(self):
+		return self.rows
+	
+	def __getitem__(self,name):
+		''' The whole column as a memmap (opened on first use) '''
+		if (name not in self.maps):
+			if (self.rows == 0):
+				self.maps[name] = numpy.zeros(0,dtype=self.dtypes[name])
+			else:
+				self.maps[name] = numpy.memmap(os.path.join(self.directory,name+'.bin'),dtype=self.dtypes[name],mode='r',shape=(self.rows,))
+		return self.maps[name]
+	
+	def array(self,columns=None,start=0,stop=None):
+		''' Copy of the columns (default all) of rows start:stop as a 2D float array, like returnNumpyData '''
+		if (columns is None): columns = self.columns
+		return numpy.column_stack([self[name][start:stop] for name in columns]).astype(float)
+
+def returnColumnarData(directory,cols=None,start=0,stop=None):
+	'''
+	Read a binary columnar dataset (SPM.columnarRecorder) and return as a numpy array
+	cols = a list of column names, all columns if None
+	'''
+	return columnarData(directory).array(cols,start,stop)
+
+class cellDataset:
+	'''
+	Lazy dataset over the output of one cell, either the csv files per cycle written by SPM.main
+	(a pattern like "data/cell1_{cycle}.csv") or a columnar dataset (SPM.columnarRecorder).
+	
+	Nothing is read until a cycle is used. The (cycle,step) -> row range index is built once:
+	for csv files per cycle file on first use, for a columnar dataset from its cycle and step
+	columns. A csv file is parsed once and kept as a .npy file next to it, which is then
+	memory-mapped (cache=False parses it every time instead).
+	
+	cycle() and step() return a dict of column name -> 1D view of the rows. With previous=True
+	the last point of the previous cycle/step is prepended as splitByCycle/splitByStep do, which is
+	still a view, except for the first step of a cycle of csv files (two files are joined).
+	relative=True returns copies with totTime_s starting at 0.
+	
+	Usage:
+	data = cellDataset("data/cell1_{cycle}.csv")
+	V = data.step(800,4)['voltage_V']
+	capacity = data.cycleEnds(['cycle','dCap_As','cCap_As'])
+	'''
+	
+	def __init__(self,source,cache=True):
+		self.cache = cache
+		self.index = {}
+		self.blocks = {}
+		
+		if (os.path.exists(os.path.join(source,'header.json'))):
+			self.columnar = columnarData(source)
+			self.columns = self.columnar.columns
+			self.files = None
+		else:
+			self.columnar = None
+			pattern = re.compile(re.escape(source).replace(re.escape('{cycle}'),'([0-9]+)')+'$')
+			self.files = {}
+			for fileName in glob.glob(source.replace('{cycle}','*')):
+				match = pattern.match(fileName)
+				if (match): self.files[int(match.group(1))] = fileName
+			if (len(self.files) == 0): raise IOError('no files match {0}'.format(source))
+			self.columns = returnHeaders(self.files[min(self.files)],kind='arr')
+	
+	def cycles(self):
+		''' The cycle numbers in the dataset '''
+		if (self.columnar is not None):
+			self.buildColumnarIndex()
+			return sorted(self.index)
+		return sorted(self.files)
+	
+	def buildColumnarIndex(self):
+		''' (cycle,step) row ranges of the whole columnar dataset, from where cycle or step changes '''
+		if (len(self.index) > 0 or len(self.columnar) == 0): return
+		cycle = self.columnar['cycle']
+		step = self.columnar['step']
+		starts = numpy.concatenate(([0],numpy.flatnonzero((numpy.diff(cycle) != 0) | (numpy.diff(step) != 0))+1))
+		stops = numpy.append(starts[1:],len(cycle))
+		for start,stop,c,st in zip(starts.tolist(),stops.tolist(),cycle[starts].tolist(),step[starts].tolist()):
+			steps = self.index.setdefault(c,{})
+			if (st not in steps): steps[st] = (start,stop)
+		self.blocks = dict((c,None) for c in self.index)
+	
+	def block(self,cycle):
+		''' The rows of a csv cycle file as a 2D array (memmapped from the .npy cache), indexing it on first use '''
+		if (self.blocks.get(cycle) is None):
+			fileName = self.files[cycle]
+			cacheFile = fileName+'.npy'
+			if (self.cache and os.path.exists(cacheFile) and os.path.getmtime(cacheFile) >= os.path.getmtime(fileName)):
+				data = numpy.load(cacheFile,mmap_mode='r')
+			else:
+				data = pandas.read_csv(fileName,comment='#',header=None,dtype=float,float_precision='round_trip').values
+				if (self.cache):
+					numpy.save(cacheFile,data)
+					data = numpy.load(cacheFile,mmap_mode='r')
+			self.blocks[cycle] = data
+			
+			step = data[:,self.columns.index('step')]
+			starts = numpy.concatenate(([0],numpy.flatnonzero(numpy.diff(step) != 0)+1))
+			stops = numpy.append(starts[1:],len(step))
+			self.index[cycle] = {}
+			for start,stop,st in zip(starts.tolist(),stops.tolist(),step[starts].tolist()):
+				if (int(st) not in self.index[cycle]): self.index[cycle][int(st)] = (start,stop)
+		return self.blocks[cycle]
+	
+	def rows(self,cycle,start,stop):
+		''' dict of column views of rows start:stop, of the cycle block for csv files '''
+		if (self.columnar is not None):
+			return dict((name,self.columnar[name][start:stop]) for name in self.columns)
+		data = self.block(cycle)
+		return dict((name,data[start:stop,j]) for j,name in enumerate(self.columns))
+	
+	def steps(self,cycle):
+		''' dict of step -> (start,stop) row range of a cycle '''
+		if (self.columnar is not None): self.buildColumnarIndex()
+		else: self.block(cycle)
+		return self.index[cycle]
+	
+	def previousRow(self,cycle):
+		''' dict of the last row of the cycle before cycle (csv files), or None '''
+		earlier = [c for c in self.files if c < cycle]
+		if (len(earlier) == 0): return None
+		last = max(earlier)
+		return self.rows(last,len(self.block(last))-1,len(self.block(last)))
+	
+	def select(self,cycle,start,stop,previous,relative):
+		if (self.columnar is not None or start > 0 or not previous):
+			rows = self.rows(cycle,start-int(previous and start > 0),stop)
+		else:
+			rows = self.rows(cycle,start,stop)
+			before = self.previousRow(cycle)
+			if (before is not None):
+				rows = dict((name,numpy.concatenate((before[name],rows[name]))) for name in self.columns)
+		if (relative):
+			rows = dict(rows)
+			rows['totTime_s'] = rows['totTime_s']-rows['totTime_s'][0]
+		return rows
+	
+	def cycle(self,cycle,previous=False,relative=False):
+		''' dict of column views of a cycle, see the class docstring for previous and relative '''
+		steps = self.steps(cycle).values()
+		return self.select(cycle,min(r[0] for r in steps),max(r[1] for r in steps),previous,relative)
+	
+	def step(self,cycle,step,previous=False,relative=False):
+		''' dict of column views of one step of a cycle, see the class docstring for previous and relative '''
+		start,stop = self.steps(cycle)[step]
+		return self.select(cycle,start,stop,previous,relative)
+	
+	def cycleEnds(self,columns=('cycle','dCap_As','cCap_As')):
+		''' The last row of every cycle as a 2D array, eg. the capacities per cycle (see returnCycleCapacity) '''
+		rows = []
+		for cycle in self.cycles():
+			stop = max(r[1] for r in self.steps(cycle).values())
+			last = self.rows(cycle,stop-1,stop)
+			rows.append([last[name][0] for name in columns])
+		return numpy.array(rows,dtype=float).reshape(len(rows),len(columns))
+
+def sqlConditions(**selection):
+	'''
+	Returns the WHERE clause and its arguments for a results database query
+	selection values may be None (everything), a number or a list of numbers
+	'''
+	conditions = []
+	arguments = []
+	for column in sorted(selection):
+		values = selection[column]
+		if (values is None): continue
+		values = list(numpy.atleast_1d(values).tolist())
+		conditions.append('{0} IN ({1})'.format(column,','.join(['?']*len(values))))
+		arguments += values
+	if (len(conditions) == 0): return '',arguments
+	return 'WHERE '+' AND '.join(conditions),arguments
+
+def queryArray(database,sql,arguments,numColumns):
+	''' Run a query on a results database (SPM.resultsStore) and return the rows as a 2D float array '''
+	connection = sqlite3.connect(database)
+	rows = connection.execute(sql,arguments).fetchall()
+	connection.close()
+	return numpy.array(rows,dtype=float).reshape(len(rows),numColumns)
+
+def queryTimeSeries(database,columns=('run','totTime_s','voltage_V'),run=None,cycle=None,step=None):
+	'''
+	Returns columns of the time series in a results database as a 2D numpy array,
+	ordered by run and time. run, cycle and step may be a number or a list
+	
+	Example: voltage vs time during step 2 of cycle 300 of every run
+	queryTimeSeries("data/results.db",['run','totTime_s','voltage_V'],cycle=300,step=2)
+	'''
+	where,arguments = sqlConditions(run=run,cycle=cycle,step=step)
+	sql = 'SELECT {0} FROM timeseries {1} ORDER BY run,rowid'.format(','.join(columns),where)
+	return queryArray(database,sql,arguments,len(columns))
+
+def queryStepEnd(database,columns=('run','voltage_V'),run=None,cycle=None,step=None):
+	'''
+	Returns columns of the last time step of every (run,cycle,step) as a 2D numpy array
+	
+	Example: the voltage at the end of step 2 of cycle 300 of every run
+	queryStepEnd("data/results.db",['run','voltage_V'],cycle=300,step=2)
+	'''
+	where,arguments = sqlConditions(run=run,cycle=cycle,step=step)
+	sql = ('SELECT {0} FROM timeseries WHERE rowid IN (SELECT MAX(rowid) FROM timeseries {1} GROUP BY run,cycle,step) '
+		'ORDER BY run,cycle,step').format(','.join(columns),where)
+	return queryArray(database,sql,arguments,len(columns))
+
+def queryCycles(database,columns=('run','cycle','dCap_As','cCap_As'),run=None,cycle=None):
+	'''
+	Returns columns of the cycle summaries as a 2D numpy array, ordered by run and cycle
+	columns: run,cycle,startTime_s,endTime_s,dCap_As,cCap_As,minVoltage_V,maxVoltage_V,maxTemp_K,rows
+	'''
+	where,arguments = sqlConditions(run=run,cycle=cycle)
+	sql = 'SELECT {0} FROM cycles {1} ORDER BY run,cycle'.format(','.join(columns),where)
+	return queryArray(database,sql,arguments,len(columns))
+
+def queryRuns(database,parameterHash=None):
+	'''
+	Returns the runs table as a numpy record array (run,parameterHash,cellNumber,created,metadata)
+	metadata is a json string, None if there are no runs
+	'''
+	connection = sqlite3.connect(database)
+	sql = 'SELECT run,parameterHash,cellNumber,created,metadata FROM runs'
+	arguments = []
+	if (parameterHash is not None):
+		sql += ' WHERE parameterHash = ?'
+		arguments = [parameterHash]
+	rows = connection.execute(sql+' ORDER BY run',arguments).fetchall()
+	connection.close()
+	return numpy.rec.fromrecords(rows,names='run,parameterHash,cellNumber,created,metadata') if rows else None
+	
 def main():
 
 	filename = 'cell1.csv'
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+'''
+Sharded batch runs of a study through a SQLite work queue
+
+A study manifest (a json file) is expanded into one job per run and stored in a SQLite
+database on a filesystem shared by all the workers. Any number of worker processes, on
+any number of hosts, claim jobs atomically (BEGIN IMMEDIATE), run them with sweep.runCell
+and store their status and results. While a job runs its worker updates a heartbeat; jobs
+whose heartbeat is older than the stale timeout belong to a crashed worker and are put
+back in the queue, up to maxAttempts times.
+
+SQLite relies on the file locks of the filesystem, which are fine locally but are broken on
+some NFS setups; keep the database on a filesystem with working fcntl locks.
+
+Manifest:
+{"parameters": ["supporting_files/parameters.xlsx"], "maxCycles": 2,
+ "cellOptions": {"controller": "error"},
+ "grid": {"positive.Rp": [4e-6, 6e-6], "others.T": [283.15, 298.15]}}
+"runs": [{...}, ...] (a list of override dicts) can be given instead of, or as well as, "grid".
+
+Usage:
+python workqueue.py submit study.db manifest.json
+python workqueue.py work study.db --output data/study --workers 4    (on every host)
+python workqueue.py status study.db
+'''
+
+import os, time, json, socket, threading, argparse
+import multiprocessing
+from SPM import getInputs, sqlite, writeTransaction
+from sweep import overrideGrid, runCell
+
+
+class workQueue:
+    """
+    The job table of a study in a SQLite database
+
+    fileName -- string, the database file, created if it does not exist
+    staleTimeout -- float, s without a heartbeat after which a running job is requeued
+    maxAttempts -- integer, number of claims of a job before it is marked failed
+    """
+
+    columns = "id INTEGER PRIMARY KEY, parameters TEXT, overrides TEXT, maxCycles INTEGER, cellOptions TEXT, " \
+              "status TEXT, worker TEXT, attempts INTEGER, claimed REAL, heartbeat REAL, finished REAL, " \
+              "result TEXT, error TEXT"
+
+    def __init__(self, fileName, staleTimeout=120.0, maxAttempts=3):
+        self.fileName = fileName
+        self.staleTimeout = staleTimeout
+        self.maxAttempts = maxAttempts
+        self.connection = sqlite.connect(fileName, timeout=60.0, isolation_level=None)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS jobs ({0})".format(self.columns))
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobStatus ON jobs (status)")
+
+    def close(self):
+        self.connection.close()
+
+    def submit(self, manifest):
+        ''' Add one job per run of the manifest (a dict, see the module docstring), returns the number of jobs '''
+        runs = list(manifest.get("runs", []))
+        if ("grid" in manifest): runs += overrideGrid(manifest["grid"])
+        if (len(runs) == 0): runs = [{}]
+
+        # fail on bad parameter names now rather than in every worker
+        inputs = getInputs(len(manifest["parameters"]) == 1, manifest["parameters"][0])
+        for overrides in runs: inputs.override(overrides)
+
+        sql = "INSERT INTO jobs (parameters, overrides, maxCycles, cellOptions, status, attempts) " \
+              "VALUES (?, ?, ?, ?, 'queued', 0)"
+        writeTransaction(self.connection, [
+            (sql, (json.dumps(manifest["parameters"]), json.dumps(overrides, sort_keys=True),
+                   manifest.get("maxCycles", 4), json.dumps(manifest.get("cellOptions", {})))) for overrides in runs])
+        return len(runs)
+
+    def claim(self, worker):
+        ''' Atomically take the oldest queued job, returns it as a dict or None when nothing is queued '''
+        now = time.time()
+        cursor = writeTransaction(self.connection, [
+            ("UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, claimed = ?, heartbeat = ? "
+             "WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1)", (worker, now, now))])
+        if (cursor.rowcount < 1): return None
+
+        row = self.connection.execute("SELECT id, parameters, overrides, maxCycles, cellOptions, attempts FROM jobs "
+                                      "WHERE worker = ? AND claimed = ? AND status = 'running'", (worker, now)).fetchone()
+        if (row is None): return None
+        return {'id': row[0], 'parameters': json.loads(row[1]), 'overrides': json.loads(row[2]),
+                'maxCycles': row[3], 'cellOptions': json.loads(row[4]), 'attempts': row[5]}
+
+    def heartbeat(self, jobId, worker):
+        ''' Returns False if the job is no longer ours (it was requeued) '''
+        cursor = writeTransaction(self.connection, [
+            ("UPDATE jobs SET heartbeat = ? WHERE id = ? AND worker = ? AND status = 'running'",
+             (time.time(), jobId, worker))])
+        return cursor.rowcount > 0
+
+    def finish(self, jobId, worker, result):
+        ''' Store the result of a job, failed runs (result['status'] != 'ok') are not retried '''
+        status = {True: 'done', False: 'failed'}[result['status'] == 'ok']
+        error = {True: None, False: result['status']}[result['status'] == 'ok']
+        writeTransaction(self.connection, [
+            ("UPDATE jobs SET status = ?, finished = ?, result = ?, error = ? "
+             "WHERE id = ? AND worker = ? AND status = 'running'",
+             (status, time.time(), json.dumps(result), error, jobId, worker))])
+
+    def requeueStale(self):
+        '''
+		Put the running jobs of crashed workers (no heartbeat for staleTimeout) back in the queue,
+		or mark them failed after maxAttempts claims. Returns the number of jobs requeued
+		'''
+        stale = time.time() - self.staleTimeout
+        cursor = writeTransaction(self.connection, [
+            ("UPDATE jobs SET status = 'failed', error = 'worker lost ' || worker WHERE status = 'running' "
+             "AND heartbeat < ? AND attempts >= ?", (stale, self.maxAttempts)),
+            ("UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND heartbeat < ?", (stale,))])
+        return cursor.rowcount
+
+    def counts(self):
+        ''' Number of jobs per status '''
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+def beat(fileName, jobId, worker, interval, stop):
+    ''' Heartbeat thread of a running job, with its own connection '''
+    queue = workQueue(fileName)
+    try:
+        while not stop.wait(interval):
+            if (not queue.heartbeat(jobId, worker)): break
+    finally:
+        queue.close()
+
+
+def work(fileName, outputDirectory, heartbeatInterval=10.0, staleTimeout=120.0, maxAttempts=3, database=None):
+    '''
+	Worker loop: requeue stale jobs, claim a job, run it, store the result, until every job is finished.
+	Every job writes to outputDirectory/job<id>, and its time steps to the resultsStore database if given.
+	Returns the number of jobs this worker ran
+	'''
+    worker = "{0}:{1}".format(socket.gethostname(), os.getpid())
+    queue = workQueue(fileName, staleTimeout, maxAttempts)
+    jobs = 0
+
+    while True:
+        queue.requeueStale()
+        job = queue.claim(worker)
+        if (job is None):
+            # jobs still running elsewhere may yet turn out to belong to a crashed worker
+            if (queue.counts().get('running', 0) == 0): break
+            time.sleep(heartbeatInterval)
+            continue
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=beat, args=(fileName, job['id'], worker, heartbeatInterval, stop))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            inputs = getInputs(len(job['parameters']) == 1, job['parameters'][0]).override(job['overrides'])
+            directory = os.path.join(outputDirectory, "job{0:06d}".format(job['id']))
+            result = runCell({'run': job['id'], 'parameters': job['parameters'], 'inputs': inputs,
+                              'maxCycles': job['maxCycles'], 'directory': directory, 'cellOptions': job['cellOptions'],
+                              'database': database, 'metadata': {'job': job['id'], 'overrides': job['overrides']}})
+        except Exception as e:
+            result = {'status': "failed: {0}: {1}".format(type(e).__name__, e)}
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        queue.finish(job['id'], worker, result)
+        print("{0}: job {1} {2}".format(worker, job['id'], result['status']))
+        jobs += 1
+
+    queue.close()
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded batch runs of the single particle model")
+    commands = parser.add_subparsers(dest='command')
+
+    submit = commands.add_parser('submit', help="add the runs of a study manifest to the queue")
+    submit.add_argument('database')
+    submit.add_argument('manifest', help="json study manifest")
+
+    worker = commands.add_parser('work', help="run jobs until the queue is empty")
+    worker.add_argument('database')
+    worker.add_argument('--output', default="data/study", help="output directory, one subdirectory per job")
+    worker.add_argument('--workers', type=int, default=1, help="number of local worker processes")
+    worker.add_argument('--heartbeat', type=float, default=10.0, help="heartbeat interval in s")
+    worker.add_argument('--stale', type=float, default=120.0, help="s without heartbeat before a job is requeued")
+    worker.add_argument('--attempts', type=int, default=3, help="claims of a job before it is marked failed")
+    worker.add_argument('--results', help="store the time steps in this SQLite results database, not in csv files")
+
+    status = commands.add_parser('status', help="number of jobs per status")
+    status.add_argument('database')
+    args = parser.parse_args()
+
+    if (args.command == 'submit'):
+        with open(args.manifest) as f:
+            manifest = json.load(f)
+        queue = workQueue(args.database)
+        print("{0} jobs queued".format(queue.submit(manifest)))
+    elif (args.command == 'work'):
+        workerArgs = (args.database, args.output, args.heartbeat, args.stale, args.attempts, args.results)
+        processes = [multiprocessing.Process(target=work, args=workerArgs) for i in range(args.workers)]
+        for process in processes: process.start()
+        for process in processes: process.join()
+
+    queue = workQueue(args.database)
+    print(", ".join("{0}: {1}".format(status, count) for status, count in sorted(queue.counts().items())))
+
+
+if __name__ == "__main__":
+    main()